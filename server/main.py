@@ -1,22 +1,47 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from flask_socketio import SocketIO, emit
-from vocode.streaming.streaming_conversation import StreamingConversation
-from vocode.streaming.agent import ChatGPTAgent
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+import socketio
+from vocode.streaming.constants import SENTENCE_ENDINGS, TEXT_TO_SPEECH_CHUNK_SIZE_SECONDS
+from vocode.streaming.models.message import BaseMessage
+from vocode.streaming.utils import get_chunk_size_per_second
+from vocode.streaming.agent.goodbye import is_goodbye_simple
 from vocode.streaming.synthesizer.eleven_labs_synthesizer import ElevenLabsSynthesizer
-from vocode.streaming.transcriber.base_transcriber import BaseTranscriber
+import io
 import os
+import wave
 import logging
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 import openai
 import asyncio
-import nest_asyncio
 import numpy as np
+
+# Optional local STT backend (CTranslate2); enabled via FASTER_WHISPER_MODEL
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+# Optional: with CUDA-capable torch installed, audio buffers are allocated in
+# pinned host memory so the backend's host->device copy runs as async DMA
+try:
+    import torch
+except ImportError:
+    torch = None
+
+_PIN_HOST_MEMORY = torch is not None and torch.cuda.is_available()
+
+def _alloc_float32(n):
+    if _PIN_HOST_MEMORY:
+        return torch.empty(n, dtype=torch.float32, pin_memory=True).numpy()
+    return np.empty(n, dtype=np.float32)
 import datetime
 import sys
+from urllib.parse import parse_qs
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, 
+logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -25,9 +50,6 @@ logger.info("Python version: %s", sys.version)
 logger.info("Current working directory: %s", os.getcwd())
 logger.info("Directory contents: %s", os.listdir())
 
-# Apply nest_asyncio to allow nested event loops
-nest_asyncio.apply()
-
 # Load environment variables
 load_dotenv()
 logger.info("Environment variables loaded")
@@ -43,253 +65,734 @@ if not openai_api_key:
 openai.api_key = openai_api_key
 logger.info("OpenAI client initialized")
 
-# Initialize Flask app
-app = Flask(__name__)
+# Initialize FastAPI app
+app = FastAPI()
 
 # Configure CORS to allow requests from your React app
-# Define allowed origins
-allowed_origins = ["http://localhost:3000", "http://192.168.178.85:3000", "https://vocode-core-kdqv.onrender.com", "https://your-vercel-app.vercel.app", "https://vocode-core-frontend.vercel.app", "https://vocode-core-jet.vercel.app"]
-
-# Add CORS middleware with dynamic origin handling
-@app.after_request
-def after_request(response):
-    origin = request.headers.get('Origin')
-    # Only add the header if it's not already present
-    if 'Access-Control-Allow-Origin' not in response.headers:
-        if origin and (origin in allowed_origins or '*' in allowed_origins):
-            response.headers.add('Access-Control-Allow-Origin', origin)
-        else:
-            response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-    return response
+# Define allowed origins (frozenset: O(1) membership checks)
+allowed_origins = frozenset({"http://localhost:3000", "http://192.168.178.85:3000", "https://vocode-core-kdqv.onrender.com", "https://your-vercel-app.vercel.app", "https://vocode-core-frontend.vercel.app", "https://vocode-core-jet.vercel.app"})
 
-# Configure CORS with Flask-CORS
-CORS(app, resources={
-    r"/*": {
-        "origins": allowed_origins,
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
-    }
-})
+# CORSMiddleware precomputes its headers once; no per-request mutation
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=list(allowed_origins),
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+)
 logger.info("CORS configured")
 
-# Configure SocketIO with CORS settings
-socketio = SocketIO(
-    app, 
-    cors_allowed_origins=allowed_origins,
+# Configure the async Socket.IO server with CORS settings
+# C-level JSON for control messages; audio itself travels as binary
+try:
+    import orjson
+
+    class _OrjsonPackager:
+        """Duck-types the json module interface python-socketio expects."""
+
+        @staticmethod
+        def dumps(obj, *args, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        @staticmethod
+        def loads(s, *args, **kwargs):
+            return orjson.loads(s)
+
+    _socketio_json = _OrjsonPackager
+except ImportError:
+    _socketio_json = None
+
+# Protocol-level logging costs a log call per packet; keep it opt-in
+socketio_debug = os.environ.get('SOCKETIO_DEBUG', '0') == '1'
+
+# Horizontal scaling: with REDIS_URL set, a Redis-backed manager lets
+# several uvicorn workers (one per core) share rooms and emits, so a
+# client's events reach it no matter which worker holds its socket
+redis_url = os.environ.get('REDIS_URL')
+client_manager = socketio.AsyncRedisManager(redis_url) if redis_url else None
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',       # Event-loop based, no per-message thread hops
+    client_manager=client_manager,
+    cors_allowed_origins=list(allowed_origins),
     ping_timeout=5,     # Match client timeout
     ping_interval=10,   # Reduce ping interval
-    async_mode='threading',  # Add threading mode for better performance
-    engineio_logger=True,    # Enable engine.io logging for debugging
-    logger=True,             # Enable Socket.IO logging
+    engineio_logger=socketio_debug,
+    logger=socketio_debug,
+    json=_socketio_json,     # orjson when available, stdlib json otherwise
     always_connect=True,     # Always accept connections
-    max_http_buffer_size=1e8, # Increase buffer size for audio data
-    path='/socket.io',        # Explicitly set the Socket.IO path
-    allow_upgrades=True,      # Allow transport upgrades
+    max_http_buffer_size=1e7, # int16 binary frames need far less than the old 1e8
     transports=['websocket']  # Force WebSocket transport only
 )
-logger.info("SocketIO initialized with WebSocket transport only")
 
-# Store active conversations
-conversations = {}
+# Wrap the FastAPI app so Socket.IO handles /socket.io and FastAPI the rest
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=app, socketio_path='/socket.io')
+logger.info("Async SocketIO initialized with WebSocket transport only")
 
-# Add a function to log all events for debugging
-def log_event(event, *args):
-    logger.info(f"Event received: {event}, Args: {args}")
+# Int16 PCM on the wire; scale once into a reusable float32 scratch
+AUDIO_SCALE = np.float32(1.0 / 32768.0)
 
-# Register the event logger
-socketio.on_event('*', log_event)
+# str.endswith wants a tuple
+SENTENCE_ENDINGS_TUPLE = tuple(SENTENCE_ENDINGS)
 
-@app.route('/', methods=['GET'])
-def index():
-    logger.info("Health check endpoint called")
-    return jsonify({"status": "Vocode API Server is running", "version": "1.0.0"})
-
-@app.route('/test-cors', methods=['GET', 'OPTIONS'])
-def test_cors():
-    if request.method == 'OPTIONS':
-        # Preflight request response
-        response = jsonify({'status': 'ok'})
-        # Don't add CORS headers here, they'll be added by the after_request function
-        return response
-    return jsonify({"status": "CORS test successful", "timestamp": str(datetime.datetime.now())})
-
-@app.route('/api/health', methods=['GET', 'OPTIONS'])
-def health_check():
-    if request.method == 'OPTIONS':
-        # Preflight request response
-        response = jsonify({'status': 'ok'})
-        # Don't add CORS headers here, they'll be added by the after_request function
-        return response
-    return jsonify({"status": "healthy"})
-
-@socketio.on('connect')
-def handle_connect():
-    logger.info(f'Client connected: {request.sid}')
-    logger.info(f'Connection details: Transport={request.environ.get("wsgi.websocket_version", "unknown")}, Headers={dict(request.headers)}')
-    emit('connection_established', {'status': 'connected', 'sid': request.sid})
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    reason = request.args.get('reason', 'unknown')
-    logger.info(f'Client disconnected: {request.sid}, Reason: {reason}')
-    if request.sid in conversations:
-        try:
-            conversations[request.sid].terminate()
-            del conversations[request.sid]
-            logger.info(f'Conversation terminated for client: {request.sid}')
-        except Exception as e:
-            logger.error(f'Error terminating conversation: {str(e)}')
+# STT calls have a fixed per-invocation cost, so frames are coalesced into
+# ~20-30 ms windows instead of being transcribed one packet at a time
+STT_SAMPLE_RATE = 16000
+STT_WINDOW_MS = int(os.environ.get('STT_WINDOW_MS', 20))
+STT_WINDOW_SAMPLES = STT_SAMPLE_RATE * STT_WINDOW_MS // 1000
+
+# Upper bound on buffered audio per client (samples)
+MAX_WINDOW_SAMPLES = STT_SAMPLE_RATE * 30
+
+# Frames a client may have queued ahead of inference; beyond this the oldest
+# frame is dropped so fresh audio never waits behind stale audio
+AUDIO_QUEUE_MAX = int(os.environ.get('AUDIO_QUEUE_MAX', 8))
+
+# Total frames dropped to backpressure across all sessions
+dropped_frames_total = 0
+
+@dataclass
+class Session:
+    """Per-client state: the transcriber plus the audio pipeline feeding it.
+
+    ``buf`` is a preallocated int16 ring that incoming samples are written
+    into at ``write_idx``; ``scratch`` receives the float32 window at flush
+    time. Both live for the whole session, so the hot path allocates
+    nothing per frame. The LLM and TTS stages run in ``_stream_reply``
+    against ``history``; there is no conversation object.
+    """
+    transcriber: object
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=AUDIO_QUEUE_MAX))
+    worker: asyncio.Task = None
+    dropped_frames: int = 0
+    # Chat history for the streaming LLM path (system preamble seeded lazily)
+    history: list = field(default_factory=list)
+    buf: np.ndarray = field(default_factory=lambda: np.empty(MAX_WINDOW_SAMPLES, dtype=np.int16))
+    write_idx: int = 0
+    scratch: np.ndarray = field(default_factory=lambda: _alloc_float32(MAX_WINDOW_SAMPLES))
+
+# Sessions live in python-socketio's per-connection store (sio.save_session)
+# rather than a module-level dict, so hot state sits next to the socket
+# record and is discarded automatically when the client goes away
 
-@socketio.on('start_conversation')
-def handle_start_conversation():
+async def _get_active_session(sid):
     try:
-        logger.info(f'Starting conversation for client: {request.sid}')
-        
-        # Set up event loop for this thread
+        session = await sio.get_session(sid)
+    except KeyError:
+        return None
+    # get_session returns a plain dict for connections without a conversation
+    return session if isinstance(session, Session) else None
+
+def _offer_frame(session, data):
+    # Bounded enqueue with drop-oldest: under overload the newest audio
+    # replaces the stalest instead of sitting behind it
+    global dropped_frames_total
+    try:
+        session.queue.put_nowait(data)
+    except asyncio.QueueFull:
         try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            # If there's no event loop in the current thread, create one
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            logger.info("Created new event loop for thread")
-        
-        # Initialize conversation components
-        from vocode.streaming.agent.chat_gpt_agent import ChatGPTAgentConfig
-        
-        agent_config = ChatGPTAgentConfig(
-            prompt_preamble="You are a helpful voice assistant that has a conversation with the user.",
-            initial_message={
-                "text": "Hello! How can I help you today?"
-            },
-            model_name="gpt-3.5-turbo",
-            openai_api_key=openai_api_key,
-            end_conversation_on_goodbye=True
-        )
-        
-        agent = ChatGPTAgent(
-            agent_config=agent_config
-        )
-        logger.info("ChatGPT agent initialized")
-        
-        # Check for ElevenLabs API key
-        elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
-        elevenlabs_voice_id = os.getenv("ELEVENLABS_VOICE_ID")
-        
-        if not elevenlabs_api_key or not elevenlabs_voice_id:
-            logger.error("ElevenLabs API key or voice ID not found")
-            emit('error', {'message': 'ElevenLabs configuration missing'})
-            return
-        
-        from vocode.streaming.synthesizer.eleven_labs_synthesizer import ElevenLabsSynthesizerConfig
-        
-        synthesizer_config = ElevenLabsSynthesizerConfig(
-            api_key=elevenlabs_api_key,
-            voice_id=elevenlabs_voice_id,
-            optimize_streaming_latency=2  # Add this parameter to optimize latency
-        )
-            
-        synthesizer = ElevenLabsSynthesizer(
-            synthesizer_config=synthesizer_config
-        )
-        logger.info("ElevenLabs synthesizer initialized")
-        
-        # Using BaseTranscriber with OpenAI configuration
-        from vocode.streaming.transcriber.base_transcriber import TranscriberConfig
-        
-        transcriber_config = TranscriberConfig(
-            model="whisper-1",
-            provider="openai",
-            openai_api_key=openai_api_key,
-            endpointing_config={
-                "type": "time_based",
-                "time_cutoff_seconds": 0.5
-            }
+            session.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        session.queue.put_nowait(data)
+        session.dropped_frames += 1
+        dropped_frames_total += 1
+        if session.dropped_frames % 50 == 1:
+            logger.warning('backpressure: dropped %d frames so far for this session', session.dropped_frames)
+
+def _ingest_frame(session, data):
+    # Write the frame's samples into the session ring at the write pointer.
+    # The protocol is fixed: 16 kHz mono int16 PCM as binary frames, so the
+    # decode path is a single frombuffer view with no format branching.
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        logger.warning('dropping non-binary audio frame (%s); protocol is s16le bytes',
+                       type(data).__name__)
+        return
+    if len(data) % 2:
+        # frombuffer would raise on a partial sample; keep the whole frames
+        logger.warning('odd-length audio frame (%d bytes); dropping trailing byte', len(data))
+    # Zero-copy view over the received buffer
+    audio = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+    n = audio.shape[0]
+    free = session.buf.shape[0] - session.write_idx
+    if n > free:
+        logger.warning('audio ring full, truncating frame')
+        audio = audio[:free]
+        n = free
+    session.buf[session.write_idx:session.write_idx + n] = audio
+    session.write_idx += n
+
+def _take_window(session):
+    # One vectorized cast of the buffered window into the float32 scratch
+    n = session.write_idx
+    out = session.scratch[:n]
+    np.multiply(session.buf[:n], AUDIO_SCALE, out=out, casting='unsafe')
+    session.write_idx = 0
+    return out
+
+def _to_pcm16(x: np.ndarray) -> np.ndarray:
+    # Clip to avoid int16 wraparound on overs
+    return np.clip(x * 32767.0, -32768, 32767).astype(np.int16, copy=False)
+
+def _to_pcm16_bytes(x: np.ndarray) -> bytes:
+    # Half the wire size of float32 PCM
+    return _to_pcm16(x).tobytes()
+
+def _encode_response(response):
+    if isinstance(response, np.ndarray):
+        if response.dtype == np.int16:
+            return response.tobytes()
+        return _to_pcm16_bytes(response)
+    return response
+
+async def _emit_audio(sid, response):
+    if response is None:
+        return
+    if hasattr(response, '__aiter__'):
+        # Streamed synthesis: forward chunks as they arrive so the client
+        # starts playback while the rest of the clip is still rendering
+        async for chunk in response:
+            await sio.emit('audio_response', _encode_response(chunk), to=sid)
+        return
+    if len(response) > 0 if hasattr(response, '__len__') else bool(response):
+        await sio.emit('audio_response', _encode_response(response), to=sid)
+
+def _synthesizer_chunk_size(synthesizer):
+    config = synthesizer.get_synthesizer_config()
+    return int(
+        TEXT_TO_SPEECH_CHUNK_SIZE_SECONDS
+        * get_chunk_size_per_second(config.audio_encoding, config.sampling_rate)
+    )
+
+async def _synthesize(synthesizer, text):
+    # vocode synthesizers expose create_speech(BaseMessage, chunk_size)
+    # returning a SynthesisResult; unwrap its chunk_generator into a plain
+    # async iterator of audio chunks for _emit_audio
+    create_speech = getattr(synthesizer, 'create_speech', None)
+    if create_speech is not None:
+        result = await create_speech(
+            BaseMessage(text=text), _synthesizer_chunk_size(synthesizer)
         )
-        
-        transcriber = BaseTranscriber(
-            transcriber_config=transcriber_config
+
+        async def chunks():
+            async for chunk_result in result.chunk_generator:
+                yield chunk_result.chunk
+
+        return chunks()
+    synthesize = getattr(synthesizer, 'synthesize', None)
+    if synthesize is not None:
+        return await _maybe_await(synthesize(text))
+    logger.error('synthesizer %s exposes neither create_speech nor synthesize; '
+                 'dropping audio for reply text', type(synthesizer).__name__)
+    return None
+
+async def _stream_completion(agent_config, messages):
+    # The one LLM entry point: real turns and warmup both go through here,
+    # so warmup exercises exactly the code path first-turn traffic hits
+    return await openai.ChatCompletion.acreate(
+        model=agent_config.model_name,
+        messages=messages,
+        temperature=agent_config.temperature,
+        max_tokens=agent_config.max_tokens,
+        stream=True,
+    )
+
+async def _stream_reply(sid, session, transcript):
+    """Pipeline the LLM reply into TTS sentence by sentence.
+
+    Tokens stream from ChatGPT; whenever the buffer reaches a sentence
+    boundary, that sentence is handed to the synthesizer and its audio is
+    emitted while later tokens are still being generated, so time-to-first-
+    audio is bounded by the first sentence instead of the full completion.
+    """
+    agent_config, synthesizer = _get_shared_components()
+    if not session.history:
+        session.history.append({"role": "system", "content": agent_config.prompt_preamble})
+    session.history.append({"role": "user", "content": transcript})
+
+    async def flush(sentence):
+        sentence = sentence.strip()
+        if sentence:
+            await _emit_audio(sid, await _synthesize(synthesizer, sentence))
+
+    stream = await _stream_completion(agent_config, session.history)
+    reply = []
+    buffer = ''
+    async for chunk in stream:
+        delta = chunk["choices"][0]["delta"].get("content", "")
+        if not delta:
+            continue
+        buffer += delta
+        if buffer.endswith(SENTENCE_ENDINGS_TUPLE):
+            reply.append(buffer)
+            await flush(buffer)
+            buffer = ''
+    if buffer:
+        reply.append(buffer)
+        await flush(buffer)
+    reply_text = ''.join(reply)
+    session.history.append({"role": "assistant", "content": reply_text})
+
+    # Same check BaseAgent applies to non-streamed turns
+    if agent_config.end_conversation_on_goodbye and (
+        is_goodbye_simple(transcript, agent_config.goodbye_phrases)
+        or is_goodbye_simple(reply_text, agent_config.goodbye_phrases)
+    ):
+        logger.info(f'Goodbye detected, ending conversation for client: {sid}')
+        await _stop_session(sid)
+        await sio.emit('conversation_ended', {'status': 'success'}, to=sid)
+
+async def _process_window(sid, session, window):
+    # STT on the buffered window, then the streamed LLM+TTS turn; the
+    # transcriber owns its own executor/batching, so this await overlaps
+    # with other clients' work
+    transcript = await session.transcriber.transcribe(window)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('transcript (%d samples): %s', len(window), transcript)
+    if transcript:
+        await _stream_reply(sid, session, transcript)
+
+async def _audio_worker(sid, session):
+    # Consume audio frames for one client so Whisper/ElevenLabs round-trips
+    # never block the socket: new frames keep arriving while inference runs.
+    # Samples accumulate in the session ring until a full window is buffered
+    # or input pauses, so the STT pipeline sees meaningful chunks instead of
+    # micro-fragments and the hot path never allocates.
+    queue = session.queue
+    window_timeout = STT_WINDOW_MS / 1000.0
+    ended = False
+    while not ended:
+        try:
+            if session.write_idx:
+                data = await asyncio.wait_for(queue.get(), timeout=window_timeout)
+            else:
+                data = await queue.get()
+        except asyncio.TimeoutError:
+            # Input paused mid-window: flush what we have
+            data = False
+        if data is None:
+            ended = True
+        elif data is not False:
+            # Ingest here, not in the handler: the worker is serial per sid,
+            # so ring writes never race with a window being processed. A
+            # malformed frame must not kill the worker and wedge the session
+            try:
+                _ingest_frame(session, data)
+            except Exception as e:
+                logger.error(f'Error ingesting audio frame: {str(e)}', exc_info=True)
+                await sio.emit('error', {'message': str(e)}, to=sid)
+                continue
+            if session.write_idx < STT_WINDOW_SAMPLES:
+                continue
+        if not session.write_idx:
+            continue
+        try:
+            await _process_window(sid, session, _take_window(session))
+        except Exception as e:
+            logger.error(f'Error processing audio: {str(e)}', exc_info=True)
+            await sio.emit('error', {'message': str(e)}, to=sid)
+
+async def _start_session(sid, transcriber):
+    session = Session(transcriber=transcriber)
+    session.worker = asyncio.create_task(_audio_worker(sid, session))
+    await sio.save_session(sid, session)
+    return session
+
+async def _stop_session(sid):
+    # The sentinel lets the worker drain in-flight frames before exiting
+    session = await _get_active_session(sid)
+    if session is not None:
+        _offer_frame(session, None)
+        try:
+            await sio.save_session(sid, {})
+        except KeyError:
+            pass  # client already fully disconnected
+    return session
+
+@app.get('/')
+async def index():
+    logger.info("Health check endpoint called")
+    return JSONResponse({"status": "Vocode API Server is running", "version": "1.0.0"})
+
+@app.get('/test-cors')
+async def test_cors():
+    return JSONResponse({"status": "CORS test successful", "timestamp": str(datetime.datetime.now())})
+
+@app.get('/api/health')
+async def health_check():
+    # Advertise the fixed wire format alongside liveness
+    return JSONResponse({
+        "status": "healthy",
+        "dropped_frames": dropped_frames_total,
+        "audio": {"pcm": "s16le", "sr": STT_SAMPLE_RATE, "ch": 1},
+    })
+
+@sio.event
+async def connect(sid, environ):
+    logger.info(f'Client connected: {sid}')
+    logger.info(f'Connection details: Transport={environ.get("asgi.scope", {}).get("type", "unknown")}')
+    # Negotiate the audio format at the handshake: a client declaring a
+    # sample rate other than 16 kHz is refused rather than resampled
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    declared_sr = query.get('sr', [str(STT_SAMPLE_RATE)])[0]
+    if declared_sr != str(STT_SAMPLE_RATE):
+        logger.warning('refusing client %s: unsupported sample rate %s', sid, declared_sr)
+        # Refusing the handshake delivers the reason in the connect_error
+        # payload; emitting to a connection that is being torn down does not
+        raise socketio.exceptions.ConnectionRefusedError(
+            f'unsupported sample rate {declared_sr}; send {STT_SAMPLE_RATE} Hz s16le PCM'
         )
-        logger.info("Transcriber initialized")
-        
-        # Initialize conversation
-        conversation = StreamingConversation(
-            agent=agent,
-            synthesizer=synthesizer,
-            transcriber=transcriber
+    await sio.emit('connection_established', {'status': 'connected', 'sid': sid}, to=sid)
+
+@sio.event
+async def disconnect(sid):
+    logger.info(f'Client disconnected: {sid}')
+    try:
+        session = await _stop_session(sid)
+        if session is not None:
+            logger.info(f'Conversation terminated for client: {sid}')
+    except Exception as e:
+        logger.error(f'Error terminating conversation: {str(e)}')
+
+# Micro-batching cap for concurrent STT requests across clients
+STT_BATCH_MAX = int(os.environ.get('STT_BATCH_MAX', 8))
+
+class _SttMicroBatcher:
+    """Coalesces concurrent transcription requests into one backend call.
+
+    Requests that pile up while a batch is in flight are drained together
+    (up to STT_BATCH_MAX) without any batching timer, so a lone client
+    never waits on a coalescing window. With a ``transcribe_batch_fn`` the
+    drained clips run as one true batched forward; without one they are
+    dispatched to the executor in parallel, matching the concurrency of
+    independent transcribe calls.
+    """
+
+    def __init__(self, transcribe_fn, transcribe_batch_fn=None):
+        self._transcribe = transcribe_fn
+        self._transcribe_batch = transcribe_batch_fn
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    async def submit(self, audio):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((audio, future))
+        return await future
+
+    def _drain_pending(self, items):
+        # Take only what has already accumulated; never wait for stragglers
+        while len(items) < STT_BATCH_MAX:
+            try:
+                items.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return items
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = self._drain_pending([await self._queue.get()])
+            clips = [audio for audio, _ in items]
+            try:
+                if self._transcribe_batch is not None:
+                    texts = await loop.run_in_executor(None, self._transcribe_batch, clips)
+                else:
+                    # No batch API: keep per-clip executor parallelism
+                    texts = await asyncio.gather(
+                        *(loop.run_in_executor(None, self._transcribe, clip) for clip in clips)
+                    )
+                for (_, future), text in zip(items, texts):
+                    if not future.done():
+                        future.set_result(text)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+class FasterWhisperTranscriber:
+    """Local whisper backend exposing ``transcribe(audio) -> text``.
+
+    Not a vocode BaseTranscriber: it never joins a conversation object, it
+    just turns a buffered float32 window into text for _process_window.
+    Runs Whisper locally on the CTranslate2 runtime with INT8 weights,
+    removing the per-utterance network round-trip to the hosted whisper-1
+    endpoint. Inference runs in the default executor so the event loop
+    stays free while a clip decodes.
+    """
+
+    # Model weights and the cross-client micro-batcher are shared process-wide
+    # so per-session construction stays cheap and concurrent clients still
+    # coalesce into the same batches; the instances themselves are per-session
+    _backends = {}
+
+    def __init__(self, model_size="small.en", device="auto", compute_type=None):
+        if compute_type is None:
+            # int8 weights on CPU; keep fp16 activations when CUDA is present
+            compute_type = "int8_float16" if device == "cuda" else "int8"
+        key = (model_size, device, compute_type)
+        backend = FasterWhisperTranscriber._backends.get(key)
+        if backend is None:
+            self.model = WhisperModel(model_size, device=device, compute_type=compute_type)
+            # The pinned faster-whisper has no batch API; newer releases that
+            # grow one get the true batched forward automatically
+            self._batcher = _SttMicroBatcher(
+                self._transcribe_sync,
+                self._transcribe_batch_sync if hasattr(self.model, "transcribe_batch") else None,
+            )
+            FasterWhisperTranscriber._backends[key] = (self.model, self._batcher)
+        else:
+            self.model, self._batcher = backend
+
+    def _transcribe_sync(self, audio):
+        segments, _info = self.model.transcribe(
+            np.asarray(audio, dtype=np.float32), beam_size=1
         )
-        logger.info("Streaming conversation initialized")
-        
-        # Store conversation with socket ID as key
-        conversations[request.sid] = conversation
-        
-        emit('conversation_started', {'status': 'success'})
-        logger.info(f'Conversation started successfully for client: {request.sid}')
+        return "".join(segment.text for segment in segments).strip()
+
+    def _transcribe_batch_sync(self, clips):
+        return [
+            "".join(segment.text for segment in segments).strip()
+            for segments in self.model.transcribe_batch(
+                [np.asarray(clip, dtype=np.float32) for clip in clips], beam_size=1
+            )
+        ]
+
+    async def transcribe(self, audio):
+        return await self._batcher.submit(audio)
+
+    async def warm_up(self):
+        # Run both extremes of clip length so the runtime's kernel and
+        # workspace allocation covers every decode shape real traffic can
+        # hit (the CTranslate2 analogue of precapturing CUDA graphs for
+        # min and max decode lengths)
+        loop = asyncio.get_running_loop()
+        for seconds in (1, 30):
+            clip = np.zeros(16000 * seconds, dtype=np.float32)
+            await loop.run_in_executor(None, self._transcribe_sync, clip)
+
+class OpenAIWhisperTranscriber:
+    """Hosted whisper-1 backend with the same ``transcribe(audio) -> text``
+    contract as FasterWhisperTranscriber.
+
+    Each window is packed into an in-memory WAV and sent through the
+    pinned openai client's async transcription call, so the event loop
+    never blocks on the network round-trip.
+    """
+
+    def __init__(self, model="whisper-1"):
+        self.model = model
+
+    def _to_wav(self, audio):
+        audio = np.asarray(audio)
+        if audio.dtype != np.int16:
+            audio = _to_pcm16(audio)
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(STT_SAMPLE_RATE)
+            wav.writeframes(audio.tobytes())
+        buffer.seek(0)
+        # The client sniffs the container format from the file name
+        buffer.name = 'audio.wav'
+        return buffer
+
+    async def transcribe(self, audio):
+        response = await openai.Audio.atranscribe(self.model, self._to_wav(audio))
+        return response["text"].strip()
+
+def _build_transcriber():
+    model_size = os.getenv("FASTER_WHISPER_MODEL")
+    if model_size:
+        if WhisperModel is None:
+            logger.warning(
+                "FASTER_WHISPER_MODEL=%s set but faster-whisper is not installed; "
+                "falling back to hosted whisper-1", model_size
+            )
+        else:
+            transcriber = FasterWhisperTranscriber(
+                model_size=model_size,
+                device=os.getenv("FASTER_WHISPER_DEVICE", "auto"),
+                compute_type=os.getenv("FASTER_WHISPER_COMPUTE_TYPE"),
+            )
+            logger.info("Local faster-whisper transcriber initialized (%s)", model_size)
+            return transcriber
+
+    transcriber = OpenAIWhisperTranscriber()
+    logger.info("Hosted whisper-1 transcriber initialized")
+    return transcriber
+
+# Shared, lazily-initialized pipeline components. The synthesizer keeps no
+# per-conversation state (create_speech is stateless), so its HTTP client is
+# paid for once and reused by every session. The agent holds chat history, so
+# only its config is shared. Transcribers are built per session in
+# start_conversation; the heavy pieces (model weights, micro-batcher) are
+# shared underneath by the backend itself.
+_shared_components = None
+
+def _get_shared_components():
+    global _shared_components
+    if _shared_components is not None:
+        return _shared_components
+
+    # The config model only; vocode's ChatGPTAgent module imports the 1.x
+    # openai client, which conflicts with the 0.27 pin this server runs on
+    from vocode.streaming.models.agent import ChatGPTAgentConfig
+
+    agent_config = ChatGPTAgentConfig(
+        prompt_preamble="You are a helpful voice assistant that has a conversation with the user.",
+        initial_message={
+            "text": "Hello! How can I help you today?"
+        },
+        model_name="gpt-3.5-turbo",
+        openai_api_key=openai_api_key,
+        end_conversation_on_goodbye=True
+    )
+
+    # Check for ElevenLabs API key
+    elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
+    elevenlabs_voice_id = os.getenv("ELEVENLABS_VOICE_ID")
+
+    if not elevenlabs_api_key or not elevenlabs_voice_id:
+        logger.error("ElevenLabs API key or voice ID not found")
+        raise ValueError("ElevenLabs configuration missing")
+
+    from vocode.streaming.models.audio import AudioEncoding
+    from vocode.streaming.synthesizer.eleven_labs_synthesizer import ElevenLabsSynthesizerConfig
+
+    synthesizer_config = ElevenLabsSynthesizerConfig(
+        api_key=elevenlabs_api_key,
+        voice_id=elevenlabs_voice_id,
+        sampling_rate=16000,
+        audio_encoding=AudioEncoding.LINEAR16,  # raw PCM, no decode step client-side
+        optimize_streaming_latency=3,  # trade a little quality for time-to-first-chunk
+        experimental_streaming=True  # stream chunks instead of waiting for the clip
+    )
+
+    synthesizer = ElevenLabsSynthesizer(
+        synthesizer_config=synthesizer_config
+    )
+    logger.info("ElevenLabs synthesizer initialized")
+
+    _shared_components = (agent_config, synthesizer)
+    return _shared_components
+
+async def _maybe_await(result):
+    if asyncio.iscoroutine(result):
+        return await result
+    return result
+
+@app.on_event("startup")
+async def warmup():
+    # Pay first-inference costs (connection setup, kernel compilation,
+    # graph capture) once at boot instead of on the first client's frame
+    if os.environ.get('WARMUP_ON_START', '1') != '1':
+        return
+    try:
+        agent_config, synthesizer = _get_shared_components()
+        transcriber = _build_transcriber()
+    except Exception as e:
+        logger.warning(f'Skipping warmup, shared components unavailable: {str(e)}')
+        return
+
+    # Use a max-expected-length clip so shorter real inputs stay inside
+    # whatever graph/kernel shapes the warmup captured
+    warmup_seconds = int(os.environ.get('WARMUP_SECONDS', 30))
+    clip = np.zeros(16000 * warmup_seconds, dtype=np.float32)
+
+    # Local backends expose warm_up to cover all decode shapes; remote
+    # backends just get one max-length clip for connection setup
+    warm_up = getattr(transcriber, 'warm_up', None)
+    transcribe = getattr(transcriber, 'transcribe', None)
+    try:
+        if warm_up is not None:
+            await _maybe_await(warm_up())
+            logger.info("Transcriber warmed up")
+        elif transcribe is not None:
+            await _maybe_await(transcribe(clip))
+            logger.info("Transcriber warmed up")
+    except Exception as e:
+        logger.warning(f'Transcriber warmup failed: {str(e)}')
+
+    try:
+        # Drain a streamed completion over a throwaway history so the LLM
+        # warmup runs the same path _stream_reply uses for real turns
+        history = [
+            {"role": "system", "content": agent_config.prompt_preamble},
+            {"role": "user", "content": "hello"},
+        ]
+        stream = await _stream_completion(agent_config, history)
+        async for _ in stream:
+            pass
+        logger.info("Agent warmed up")
+    except Exception as e:
+        logger.warning(f'Agent warmup failed: {str(e)}')
+
+    try:
+        result = await _synthesize(synthesizer, "hello")
+        if hasattr(result, '__aiter__'):
+            # Drain the chunk stream so the synthesis actually runs
+            async for _ in result:
+                pass
+        logger.info("Synthesizer warmed up")
+    except Exception as e:
+        logger.warning(f'Synthesizer warmup failed: {str(e)}')
+
+@sio.event
+async def start_conversation(sid):
+    try:
+        logger.info(f'Starting conversation for client: {sid}')
+
+        # Fail fast if the shared agent/synthesizer config is broken before
+        # the session starts; the transcriber is per-session so its window
+        # buffering never crosses clients
+        _get_shared_components()
+        transcriber = _build_transcriber()
+
+        # No conversation object: the transcriber feeds _process_window and
+        # the LLM/TTS turn runs in _stream_reply with history on the Session
+        await _start_session(sid, transcriber)
+
+        await sio.emit('conversation_started', {'status': 'success'}, to=sid)
+        logger.info(f'Conversation started successfully for client: {sid}')
     except Exception as e:
         logger.error(f'Error starting conversation: {str(e)}', exc_info=True)
-        emit('error', {'message': str(e)})
+        await sio.emit('error', {'message': str(e)}, to=sid)
 
-@socketio.on('audio_data')
-def handle_audio_data(data):
+@sio.event
+async def audio_data(sid, data):
     try:
-        # Log data type and size for debugging
-        data_type = type(data).__name__
-        data_size = len(data) if hasattr(data, '__len__') else 'unknown'
-        logger.debug(f'Received audio data: Type={data_type}, Size={data_size}')
-        
-        conversation = conversations.get(request.sid)
-        if conversation:
-            # Convert data to the format expected by the conversation
-            # If data is a list, convert it to a numpy array
-            if isinstance(data, list):
-                data = np.array(data, dtype=np.float32)
-                logger.debug(f'Converted list to numpy array: Shape={data.shape}, dtype={data.dtype}')
-            
-            # Process audio data through the conversation
-            response = conversation.process_audio(data)
-            if response:
-                logger.debug(f'Audio response generated: Type={type(response).__name__}, Size={len(response) if hasattr(response, "__len__") else "unknown"}')
-                emit('audio_response', response)
-            else:
-                logger.debug('No audio response generated')
+        # Guarded and lazily formatted: this runs per packet
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('audio frame %s %s', type(data).__name__,
+                         len(data) if hasattr(data, '__len__') else 'unknown')
+
+        session = await _get_active_session(sid)
+        if session is not None:
+            # Hand the raw frame to the per-client worker; the socket stays
+            # free to ingest the next frame while inference is in flight
+            _offer_frame(session, data)
         else:
-            logger.warning(f'No active conversation found for client: {request.sid}')
-            emit('error', {'message': 'No active conversation found'})
+            logger.warning(f'No active conversation found for client: {sid}')
+            await sio.emit('error', {'message': 'No active conversation found'}, to=sid)
     except Exception as e:
         logger.error(f'Error processing audio: {str(e)}', exc_info=True)
-        emit('error', {'message': str(e)})
+        await sio.emit('error', {'message': str(e)}, to=sid)
 
-@socketio.on('end_conversation')
-def handle_end_conversation():
+@sio.event
+async def end_conversation(sid):
     try:
-        conversation = conversations.get(request.sid)
-        if conversation:
-            conversation.terminate()
-            del conversations[request.sid]
-            emit('conversation_ended', {'status': 'success'})
-            logger.info(f'Conversation ended for client: {request.sid}')
+        session = await _stop_session(sid)
+        if session:
+            await sio.emit('conversation_ended', {'status': 'success'}, to=sid)
+            logger.info(f'Conversation ended for client: {sid}')
         else:
-            logger.warning(f'No active conversation found to end for client: {request.sid}')
+            logger.warning(f'No active conversation found to end for client: {sid}')
     except Exception as e:
         logger.error(f'Error ending conversation: {str(e)}', exc_info=True)
-        emit('error', {'message': str(e)})
-
-if __name__ == '__main__':
-    # Get port from environment variable or use default
-    port = int(os.environ.get('PORT', 8000))
-    
-    # In production, we should use 0.0.0.0 to bind to all interfaces
-    host = os.environ.get('HOST', '0.0.0.0')
-    
-    logger.info(f"Starting server on host {host} and port {port}")
-    logger.info(f"Current directory: {os.getcwd()}")
-    logger.info(f"Available environment variables: {list(os.environ.keys())}")
-    
-    try:
-        # Use debug=False in production
-        socketio.run(app, host=host, port=port, debug=False, allow_unsafe_werkzeug=True)
-    except Exception as e:
-        logger.error(f"Error starting server: {str(e)}", exc_info=True)
-        sys.exit(1)
\ No newline at end of file
+        await sio.emit('error', {'message': str(e)}, to=sid)
+
+# Launched by uvicorn (see Procfile), e.g.:
+#   uvicorn main:asgi_app --workers $(nproc) --loop uvloop --http httptools --ws websockets
+# With more than one worker, set REDIS_URL so the workers share Socket.IO state.
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The demo server is a standalone app next to the package, not part of it;
+# make its module importable and satisfy its import-time API key check
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "server"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
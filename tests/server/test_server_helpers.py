@@ -0,0 +1,117 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main", reason="server requirements not installed")
+
+
+def make_session():
+    return main.Session(transcriber=None)
+
+
+@pytest.mark.asyncio
+async def test_offer_frame_drops_oldest_under_backpressure():
+    session = make_session()
+    for i in range(main.AUDIO_QUEUE_MAX):
+        main._offer_frame(session, i)
+    assert session.queue.qsize() == main.AUDIO_QUEUE_MAX
+    assert session.dropped_frames == 0
+
+    main._offer_frame(session, "newest")
+
+    assert session.queue.qsize() == main.AUDIO_QUEUE_MAX
+    assert session.dropped_frames == 1
+    # Frame 0 was sacrificed; the newest frame made it in at the tail
+    drained = [session.queue.get_nowait() for _ in range(main.AUDIO_QUEUE_MAX)]
+    assert drained[0] == 1
+    assert drained[-1] == "newest"
+
+
+@pytest.mark.asyncio
+async def test_ingest_frame_drops_trailing_byte_of_odd_frame():
+    session = make_session()
+    samples = np.array([100, -200], dtype=np.int16)
+    main._ingest_frame(session, samples.tobytes() + b"\x7f")
+
+    assert session.write_idx == 2
+    assert np.array_equal(session.buf[:2], samples)
+
+
+@pytest.mark.asyncio
+async def test_ingest_frame_rejects_non_binary_payload():
+    session = make_session()
+    main._ingest_frame(session, [1, 2, 3])
+    assert session.write_idx == 0
+
+
+@pytest.mark.asyncio
+async def test_ingest_frame_truncates_when_ring_is_full():
+    session = make_session()
+    session.write_idx = main.MAX_WINDOW_SAMPLES - 1
+    main._ingest_frame(session, np.array([1, 2, 3], dtype=np.int16).tobytes())
+    assert session.write_idx == main.MAX_WINDOW_SAMPLES
+
+
+@pytest.mark.asyncio
+async def test_take_window_scales_to_float32_and_resets():
+    session = make_session()
+    samples = np.array([0, 16384, -16384, 32767], dtype=np.int16)
+    main._ingest_frame(session, samples.tobytes())
+
+    window = main._take_window(session)
+
+    assert window.dtype == np.float32
+    assert np.allclose(window, samples.astype(np.float32) / 32768.0)
+    assert session.write_idx == 0
+    assert len(main._take_window(session)) == 0
+
+
+def test_to_pcm16_clips_overs():
+    pcm = main._to_pcm16(np.array([2.0, -2.0, 0.0], dtype=np.float32))
+    assert pcm.dtype == np.int16
+    assert pcm.tolist() == [32767, -32768, 0]
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_fans_out_without_batch_fn():
+    def transcribe(clip):
+        return f"text-{clip}"
+
+    batcher = main._SttMicroBatcher(transcribe)
+    results = await asyncio.gather(*(batcher.submit(c) for c in ("a", "b", "c")))
+    assert results == ["text-a", "text-b", "text-c"]
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_coalesces_pending_requests():
+    release = threading.Event()
+    batch_sizes = []
+
+    def transcribe_batch(clips):
+        batch_sizes.append(len(clips))
+        release.wait(timeout=5)
+        return [f"text-{clip}" for clip in clips]
+
+    batcher = main._SttMicroBatcher(None, transcribe_batch)
+    first = asyncio.create_task(batcher.submit("a"))
+    await asyncio.sleep(0.05)  # first batch is now in flight
+    rest = [asyncio.create_task(batcher.submit(c)) for c in ("b", "c", "d")]
+    await asyncio.sleep(0.05)  # these pile up behind the in-flight batch
+    release.set()
+
+    results = await asyncio.gather(first, *rest)
+    assert results == ["text-a", "text-b", "text-c", "text-d"]
+    # The stragglers were drained together, not one batch each
+    assert batch_sizes == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_propagates_backend_errors():
+    def transcribe(clip):
+        raise RuntimeError("decode failed")
+
+    batcher = main._SttMicroBatcher(transcribe)
+    with pytest.raises(RuntimeError, match="decode failed"):
+        await batcher.submit("a")